@@ -62,9 +62,13 @@ class Config(object):
         self._C.MODEL.SESSION = 'UW'
         self._C.MODEL.INPUT = 'input'
         self._C.MODEL.TARGET = 'target'
+        self._C.MODEL.COMPILE = False
 
         self._C.OPTIM = CN()
         self._C.OPTIM.BATCH_SIZE = 1
+        self._C.OPTIM.GRAD_ACCUM_STEPS = 1
+        self._C.OPTIM.BUCKET_CAP_MB = 25
+        self._C.OPTIM.LPIPS_EVERY = 1
         self._C.OPTIM.SEED = 3407
         self._C.OPTIM.NUM_EPOCHS = 300
         self._C.OPTIM.NEPOCH_DECAY = [100]
@@ -72,6 +76,7 @@ class Config(object):
         self._C.OPTIM.LR_MIN = 0.0002
         self._C.OPTIM.BETA1 = 0.5
         self._C.OPTIM.WANDB = False
+        self._C.OPTIM.MIXED_PRECISION = 'no'
 
         self._C.TRAINING = CN()
         self._C.TRAINING.VAL_AFTER_EVERY = 3
@@ -79,6 +84,7 @@ class Config(object):
         self._C.TRAINING.WEIGHT = None
         self._C.TRAINING.TRAIN_DIR = 'images_dir/train'
         self._C.TRAINING.VAL_DIR = 'images_dir/val'
+        self._C.TRAINING.TRAIN_SHARDS = ''
         self._C.TRAINING.SAVE_DIR = 'checkpoints'
         self._C.TRAINING.PS_W = 512
         self._C.TRAINING.PS_H = 512
@@ -90,6 +96,7 @@ class Config(object):
         self._C.TESTING.TARGET = 'target'
         self._C.TESTING.VAL_DIR = 'images_dir/test'
         self._C.TESTING.WEIGHT = None
+        self._C.TESTING.EVAL_BATCH = 16
         self._C.TESTING.SAVE_IMAGES = True
         self._C.TESTING.RESULT_DIR = 'result'
         self._C.TESTING.LOG_FILE = 'log.txt'
@@ -1 +1,2 @@
-from .data_RGB import get_data
+from .cached import CachedDataLoader
+from .data_RGB import get_data, get_data_shards
@@ -0,0 +1,36 @@
+import math
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+# Loader over a paired dataset decoded once into pinned host memory
+class CachedDataLoader(object):
+    def __init__(self, dataset, batch_size, device, num_workers=8, process_index=0, num_processes=1):
+        # every process only decodes and serves its own share of the samples
+        dataset = Subset(dataset, range(process_index, len(dataset), num_processes))
+
+        inps, tars, self.names = [], [], []
+        # images are stored as uint8, which to_tensor maps back to the same float values
+        for inp, tar, names in DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers):
+            inps.append(inp.mul(255).round().to(torch.uint8))
+            tars.append(tar.mul(255).round().to(torch.uint8))
+            self.names.extend(names)
+
+        self.inp = torch.cat(inps)
+        self.tar = torch.cat(tars)
+        if torch.cuda.is_available():
+            self.inp = self.inp.pin_memory()
+            self.tar = self.tar.pin_memory()
+
+        self.batch_size = batch_size
+        self.device = device
+
+    def __len__(self):
+        return math.ceil(len(self.names) / self.batch_size)
+
+    def __iter__(self):
+        for i in range(0, len(self.names), self.batch_size):
+            inp = self.inp[i:i + self.batch_size].to(self.device, non_blocking=True).float().div(255)
+            tar = self.tar[i:i + self.batch_size].to(self.device, non_blocking=True).float().div(255)
+            yield inp, tar, self.names[i:i + self.batch_size]
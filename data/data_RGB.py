@@ -1,5 +1,5 @@
 import os
-from .dataset_RGB import DataReader, NonRefDataReader
+from .dataset_RGB import DataReader, NonRefDataReader, ShardDataReader
 
 
 def get_data(img_dir, inp, tar, mode='train', ori=False, img_options=None):
@@ -11,3 +11,7 @@ def get_data_nonref(img_dir, inp, mode='train', ori=False, img_options=None):
     assert os.path.exists(img_dir)
     return NonRefDataReader(img_dir, inp, mode, ori, img_options)
 
+
+def get_data_shards(shard_dir, mode='train', ori=False, img_options=None):
+    assert os.path.exists(shard_dir)
+    return ShardDataReader(shard_dir, mode, ori, img_options)
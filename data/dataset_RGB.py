@@ -1,10 +1,13 @@
+import glob
+import io
 import os
 
 import albumentations as A
+import cv2
 import numpy as np
 import torchvision.transforms.functional as F
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 import random
 
 
@@ -12,6 +15,23 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in ['jpeg', 'JPEG', 'jpg', 'png', 'JPG', 'PNG', 'gif'])
 
 
+# every DataLoader worker decodes on a single thread
+cv2.setNumThreads(0)
+
+
+def decode_img(buf):
+    # OpenCV decodes with libjpeg-turbo/libpng SIMD paths, noticeably faster than PIL
+    img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:  # formats OpenCV cannot read, e.g. gif
+        return np.array(Image.open(io.BytesIO(buf)).convert('RGB'))
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def load_img(path):
+    with open(path, 'rb') as f:
+        return decode_img(f.read())
+
+
 # DataReader without Reference/Target/Labeled Sample
 class NonRefDataReader(Dataset):
     def __init__(self, img_dir, inp='input', mode='train', ori=False, img_options=None):
@@ -110,15 +130,56 @@ class NonRefDataReader(Dataset):
     def load(self, index_):
         inp_path = self.inp_filenames[index_]
 
-        inp_img = Image.open(inp_path).convert('RGB')
-
-        inp_img = np.array(inp_img)
+        inp_img = load_img(inp_path)
 
         transformed = self.transform(image=inp_img)
 
         return inp_path, transformed
 
 
+def paired_transform(mode='train', ori=False, img_options=None):
+    # augmentations applied identically to the input and its target
+    if mode == 'train':
+        transform = A.Compose([
+            A.Flip(p=0.3),
+            A.RandomRotate90(p=0.3),
+            A.Rotate(p=0.3),
+            A.Transpose(p=0.3),
+            A.RandomResizedCrop(height=img_options['h'], width=img_options['w']),
+        ],
+            additional_targets={
+                'target': 'image',
+            }
+        )
+        degrade = A.Compose([
+            # A.ColorJitter(),
+            # A.RGBShift(),
+            A.NoOp()
+        ])
+    else:
+        if ori:
+            transform = A.Compose([
+                A.NoOp(),
+            ],
+                additional_targets={
+                    'target': 'image',
+                }
+            )
+        else:
+            transform = A.Compose([
+                A.Resize(height=img_options['h'], width=img_options['w']),
+            ],
+                additional_targets={
+                    'target': 'image',
+                }
+            )
+        degrade = A.Compose([
+            A.NoOp(),
+        ])
+
+    return transform, degrade
+
+
 class DataReader(Dataset):
     def __init__(self, img_dir, inp='input', tar='target', mode='train', ori=False, img_options=None):
         super(DataReader, self).__init__()
@@ -135,43 +196,7 @@ class DataReader(Dataset):
 
         self.sizex = len(self.tar_filenames)  # get the size of target
 
-        if self.mode == 'train':
-            self.transform = A.Compose([
-                A.Flip(p=0.3),
-                A.RandomRotate90(p=0.3),
-                A.Rotate(p=0.3),
-                A.Transpose(p=0.3),
-                A.RandomResizedCrop(height=img_options['h'], width=img_options['w']),
-            ],
-                additional_targets={
-                    'target': 'image',
-                }
-            )
-            self.degrade = A.Compose([
-                # A.ColorJitter(),
-                # A.RGBShift(),
-                A.NoOp()
-            ])
-        else:
-            if ori:
-                self.transform = A.Compose([
-                    A.NoOp(),
-                ],
-                    additional_targets={
-                        'target': 'image',
-                    }
-                )
-            else:
-                self.transform = A.Compose([
-                    A.Resize(height=img_options['h'], width=img_options['w']),
-                ],
-                    additional_targets={
-                        'target': 'image',
-                    }
-                )
-            self.degrade = A.Compose([
-                A.NoOp(),
-            ])
+        self.transform, self.degrade = paired_transform(self.mode, ori, img_options)
 
     def mixup(self, inp_img, tar_img, mode='mixup'):
         mixup_index_ = random.randint(0, self.sizex - 1)
@@ -250,12 +275,59 @@ class DataReader(Dataset):
         inp_path = self.inp_filenames[index_]
         tar_path = self.tar_filenames[index_]
 
-        inp_img = Image.open(inp_path).convert('RGB')
-        tar_img = Image.open(tar_path).convert('RGB')
-
-        inp_img = np.array(inp_img)
-        tar_img = np.array(tar_img)
+        inp_img = load_img(inp_path)
+        tar_img = load_img(tar_path)
 
         transformed = self.transform(image=inp_img, target=tar_img)
 
         return tar_path, transformed
+
+
+# DataReader over the WebDataset tar shards written by make_shards.py
+class ShardDataReader(IterableDataset):
+    def __init__(self, shard_dir, mode='train', ori=False, img_options=None):
+        super(ShardDataReader, self).__init__()
+
+        # only needed for sharded training data
+        import webdataset as wds
+
+        self.shards = sorted(glob.glob(os.path.join(shard_dir, '*.tar')))
+
+        self.mode = mode
+
+        self.img_options = img_options
+
+        with open(os.path.join(shard_dir, 'size.txt')) as f:
+            self.sizex = int(f.read())  # get the size of target
+
+        self.transform, self.degrade = paired_transform(self.mode, ori, img_options)
+
+        # shards are split between DataLoader workers; with Accelerate the main process
+        # reads the batches and dispatches them, so shards are not split between nodes
+        self.pipeline = wds.WebDataset(self.shards, shardshuffle=self.mode == 'train', nodesplitter=None)
+        if self.mode == 'train':
+            self.pipeline = self.pipeline.shuffle(1000)
+        # only tensors are yielded, Accelerate concatenates and broadcasts dispatched batches
+        self.pipeline = self.pipeline.to_tuple('inp.img', 'tar.img').map(self.load)
+
+    def __len__(self):
+        return self.sizex
+
+    def __iter__(self):
+        return iter(self.pipeline)
+
+    def load(self, sample):
+        inp_buf, tar_buf = sample
+
+        inp_img = decode_img(inp_buf)
+        tar_img = decode_img(tar_buf)
+
+        transformed = self.transform(image=inp_img, target=tar_img)
+
+        if self.mode == 'train':
+            inp_img = F.to_tensor(self.degrade(image=transformed['image'])['image'])
+        else:
+            inp_img = F.to_tensor(transformed['image'])
+        tar_img = F.to_tensor(transformed['target'])
+
+        return inp_img, tar_img
@@ -0,0 +1,43 @@
+import os
+import math
+
+import webdataset as wds
+from tqdm import tqdm
+
+from config import Config
+from data import get_data
+
+NUM_SHARDS = 64  # a few shards per DataLoader worker, so every worker reads its own files
+
+
+def make_shards():
+    opt = Config('config.yml')
+
+    train_dataset = get_data(opt.TRAINING.TRAIN_DIR, opt.MODEL.INPUT, opt.MODEL.TARGET, 'train', opt.TRAINING.ORI,
+                             {'w': opt.TRAINING.PS_W, 'h': opt.TRAINING.PS_H})
+
+    shard_dir = opt.TRAINING.TRAIN_SHARDS
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # store the encoded files as they are, decoding happens in ShardDataReader
+    maxcount = math.ceil(train_dataset.sizex / NUM_SHARDS)
+    pairs = zip(train_dataset.inp_filenames, train_dataset.tar_filenames)
+    with wds.ShardWriter(os.path.join(shard_dir, 'train-%06d.tar'), maxcount=maxcount) as sink:
+        for index, (inp_path, tar_path) in enumerate(tqdm(pairs, total=train_dataset.sizex)):
+            with open(inp_path, 'rb') as f:
+                inp_buf = f.read()
+            with open(tar_path, 'rb') as f:
+                tar_buf = f.read()
+
+            sink.write({
+                '__key__': '%08d' % index,
+                'inp.img': inp_buf,
+                'tar.img': tar_buf,
+            })
+
+    with open(os.path.join(shard_dir, 'size.txt'), mode='w', encoding='utf-8') as f:
+        f.write(str(train_dataset.sizex))
+
+
+if __name__ == '__main__':
+    make_shards()
@@ -28,41 +28,29 @@ def uciqe(image):
     return uciqe
 
 
-# improve the following code to support batch operation:
-def torch_uciqe(image):
+def torch_uciqe(images):
+    # images: (N, 3, H, W), returns one score per image
     # RGB转为HSV
-    hsv = color.rgb_to_hsv(image)  
-    H, S, V = torch.chunk(hsv, 3)
+    hsv = color.rgb_to_hsv(images)
+    H, S, V = torch.chunk(hsv, 3, dim=1)
 
     # 色度的标准差
-    delta = torch.std(H) / (2 * math.pi)
-    
+    delta = torch.std(H.flatten(1), dim=1) / (2 * math.pi)
+
     # 饱和度的平均值
-    mu = torch.mean(S)  
-    
+    mu = torch.mean(S.flatten(1), dim=1)
+
     # 求亮度对比值
-    n, m = V.shape[1], V.shape[2]
+    n, m = V.shape[2], V.shape[3]
     number = math.floor(n * m / 100)
-    v = V.flatten()
-    v, _ = v.sort()
-    bottom = torch.sum(v[:number]) / number
-    v = -v
-    v, _ = v.sort()
-    v = -v
-    top = torch.sum(v[:number]) / number
+    v, _ = V.flatten(1).sort(dim=1)
+    bottom = torch.sum(v[:, :number], dim=1) / number
+    top = torch.sum(v[:, -number:], dim=1) / number
     conl = top - bottom
     uciqe = 0.4680 * delta + 0.2745 * conl + 0.2576 * mu
     # uciqe = 0.25 * delta + 0.6 * conl + 0.15 * mu
     return uciqe
 
-def batch_uciqe(images):
-    uciqe_sum = 0
-    for img in images:
-        uciqe = torch_uciqe(img)
-        uciqe_sum += uciqe
-
-    avg_ucique = uciqe_sum / len(images)
-    return avg_ucique
 
-
-    
\ No newline at end of file
+def batch_uciqe(images):
+    return torch_uciqe(images).mean()
@@ -17,9 +17,9 @@ sobel_kernel_y = torch.tensor(
 
 def _uiconm(x, window_size):
     # Ensure image is divisible by window_size - doesn't matter if we cut out some pixels
-    k1 = x.shape[2] // window_size
-    k2 = x.shape[1] // window_size
-    x = x[:, :k2 * window_size, :k1 * window_size]
+    k1 = x.shape[3] // window_size
+    k2 = x.shape[2] // window_size
+    x = x[:, :, :k2 * window_size, :k1 * window_size]
 
     # Weight
     w = -1. / (k1 * k2)
@@ -28,16 +28,13 @@ def _uiconm(x, window_size):
     alpha = 1
 
     # Create blocks
-    # 3, 108, 192, 10, 10
-    x = x.unfold(1, window_size, window_size).unfold(
-        2, window_size, window_size)
-    x = x.reshape(-1, k2, k1, window_size, window_size)
+    # N, 3, 108, 192, 10, 10
+    x = x.unfold(2, window_size, window_size).unfold(
+        3, window_size, window_size)
 
-    # Compute min and max values for each block
-    min_ = torch.min(torch.min(torch.min(x, dim=-1).values,
-                     dim=-1).values, dim=0).values
-    max_ = torch.max(torch.max(torch.max(x, dim=-1).values,
-                     dim=-1).values, dim=0).values
+    # Compute min and max values for each block, over the window and the channels
+    min_ = x.amin(dim=(-1, -2)).amin(dim=1)
+    max_ = x.amax(dim=(-1, -2)).amax(dim=1)
 
     # Calculate top and bot
     top = max_ - min_
@@ -51,20 +48,20 @@ def _uiconm(x, window_size):
                       (top == 0.0), torch.zeros_like(val), val)
 
     # Sum up the values and apply the weight
-    val = w * val.sum()
+    val = w * val.sum(dim=(1, 2))
 
     return val
 
 
 def mu_a(x, alpha_L=0.1, alpha_R=0.1):
     """
-      Calculates the asymetric alpha-trimmed mean
+      Calculates the asymetric alpha-trimmed mean of each row
     """
     # sort pixels by intensity - for clipping
-    x = x.sort()[0]
+    x = x.sort(dim=1)[0]
 
     # get number of pixels
-    K = len(x)
+    K = x.shape[1]
     # calculate T alpha L and T alpha R
     T_a_L = math.ceil(alpha_L*K)
     T_a_R = math.floor(alpha_R*K)
@@ -74,20 +71,20 @@ def mu_a(x, alpha_L=0.1, alpha_R=0.1):
     # loop through flattened image starting at T_a_L+1 and ending at K-T_a_R
     s = int(T_a_L+1)
     e = int(K-T_a_R)
-    val = torch.sum(x[s:e])
+    val = torch.sum(x[:, s:e], dim=1)
     val = weight*val
     return val
 
 
 def s_a(x, mu):
-    val = torch.sum(torch.pow(x - mu, 2)) / len(x)
+    val = torch.sum(torch.pow(x - mu[:, None], 2), dim=1) / x.shape[1]
     return val
 
 
 def _uicm(x):
-    R = x[0, :, :].flatten()
-    G = x[1, :, :].flatten()
-    B = x[2, :, :].flatten()
+    R = x[:, 0].flatten(1)
+    G = x[:, 1].flatten(1)
+    B = x[:, 2].flatten(1)
     RG = R-G
     YB = ((R+G)/2)-B
 
@@ -106,60 +103,43 @@ def _uism(x):
     """
       Underwater Image Sharpness Measure
     """
-    # get image channels
-    R = x[0, :, :]
-    G = x[1, :, :]
-    B = x[2, :, :]
     # first apply Sobel edge detector to each RGB component
-    Rs = sobel_torch(R)
-    Gs = sobel_torch(G)
-    Bs = sobel_torch(B)
+    edges = sobel_torch(x)
     # multiply the edges detected for each channel by the channel itself
-    R_edge_map = torch.multiply(Rs, R)
-    G_edge_map = torch.multiply(Gs, G)
-    B_edge_map = torch.multiply(Bs, B)
+    edge_map = torch.multiply(edges, x)
     # get eme for each channel
-    r_eme = eme(R_edge_map, 10)
-    g_eme = eme(G_edge_map, 10)
-    b_eme = eme(B_edge_map, 10)
+    channel_eme = eme(edge_map, 10)
     # coefficients
-    lambda_r = 0.299
-    lambda_g = 0.587
-    lambda_b = 0.144
-    return (lambda_r*r_eme) + (lambda_g*g_eme) + (lambda_b*b_eme)
+    lambda_rgb = torch.tensor([0.299, 0.587, 0.144], dtype=x.dtype, device=x.device)
+    return (channel_eme * lambda_rgb).sum(dim=1)
 
 
 def eme(x, window_size):
     """
-    Enhancement measure estimation
-    x.shape[0] = height
-    x.shape[1] = width
+    Enhancement measure estimation of each channel
+    x.shape[2] = height
+    x.shape[3] = width
     """
     # Ensure image is divisible by window_size - doesn't matter if we cut out some pixels
-    k1 = x.shape[1] // window_size
-    k2 = x.shape[0] // window_size
-    x = x[:k2 * window_size, :k1 * window_size]
+    k1 = x.shape[3] // window_size
+    k2 = x.shape[2] // window_size
+    x = x[:, :, :k2 * window_size, :k1 * window_size]
 
-    # Reshape x into a tensor with shape (k2, window_size, k1, window_size)
-    x = x.view(k2, window_size, k1, window_size)
-
-    # Transpose and reshape the tensor into shape (k2*k1, window_size*window_size)
-    x = x.permute(0, 2, 1, 3).contiguous().view(-1, window_size * window_size)
+    # Split x into blocks of shape (N, C, k2, k1, window_size, window_size)
+    x = x.unfold(2, window_size, window_size).unfold(3, window_size, window_size)
 
     # Compute the max and min values for each block
-    max_vals, _ = torch.max(x, dim=1)
-    min_vals, _ = torch.min(x, dim=1)
+    max_vals = x.amax(dim=(-1, -2))
+    min_vals = x.amin(dim=(-1, -2))
 
     # Bound checks, can't do log(0)
     non_zero_mask = (min_vals != 0) & (max_vals != 0)
 
     # Compute the log ratios
-    log_ratios = torch.zeros_like(max_vals)
-    log_ratios[non_zero_mask] = torch.log(
-        max_vals[non_zero_mask] / min_vals[non_zero_mask])
+    log_ratios = torch.where(non_zero_mask, torch.log(max_vals / min_vals), torch.zeros_like(max_vals))
 
     # Compute the sum of the log ratios
-    val = log_ratios.sum()
+    val = log_ratios.sum(dim=(2, 3))
 
     # Compute the weight
     w = 2. / (k1 * k2)
@@ -168,18 +148,21 @@ def eme(x, window_size):
 
 
 def sobel_torch(x):
-    x = x.squeeze(0)
-    dx = F.conv2d(x[None, None], sobel_kernel_x.to(x.device), padding=1)
-    dy = F.conv2d(x[None, None], sobel_kernel_y.to(x.device), padding=1)
+    # x: (N, C, H, W), each channel is filtered and normalised independently
+    n, c, h, w = x.shape
+    x = x.reshape(n * c, 1, h, w)
+    dx = F.conv2d(x, sobel_kernel_x.to(x.device, x.dtype), padding=1)
+    dy = F.conv2d(x, sobel_kernel_y.to(x.device, x.dtype), padding=1)
     mag = torch.hypot(dx, dy)
-    mag *= 255.0 / torch.max(mag)
-    return mag.squeeze()
+    mag = mag * (255.0 / mag.amax(dim=(1, 2, 3), keepdim=True))
+    return mag.reshape(n, c, h, w)
 
 
-def torch_uiqm(img):
+def torch_uiqm(images):
+    # images: (N, 3, H, W), returns one score per image
 
     # x = img.mul(255).sub_(0.5).clamp_(0, 255)
-    x = img * 255
+    x = images * 255
 
     c1 = 0.0282
     c2 = 0.2953
@@ -194,13 +177,6 @@ def torch_uiqm(img):
 
     return uiqm
 
-def batch_uiqm(images):
-    uiqm_sum = 0
-    for img in images:
-        uiqm = torch_uiqm(img)
-        uiqm_sum += uiqm
-    avg_uiqm = uiqm_sum / len(images)
-
-    return avg_uiqm
-
 
+def batch_uiqm(images):
+    return torch_uiqm(images).mean()
@@ -414,7 +414,7 @@ class ContextBlock(nn.Module):
         batch, channel, height, width = x.size()
         input_x = x
         # [N, C, H * W]
-        input_x = input_x.view(batch, channel, height * width)
+        input_x = input_x.reshape(batch, channel, height * width)
         # [N, 1, C, H * W]
         input_x = input_x.unsqueeze(1)
         # [N, 1, H, W]
@@ -1,19 +1,21 @@
 import json
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torchvision
 
 from metrics.uciqe import batch_uciqe
 from metrics.uiqm import batch_uiqm
 
-from accelerate import Accelerator
+from accelerate import Accelerator, DataLoaderConfiguration
 from torch.utils.data import DataLoader
 from torchmetrics.functional import peak_signal_noise_ratio, structural_similarity_index_measure
 from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 from tqdm import tqdm
 
 from config import Config
-from data import get_data
+from data import CachedDataLoader, get_data
 from models import *
 
 from utils import *
@@ -24,8 +26,12 @@ warnings.filterwarnings('ignore')
 def test():
     opt = Config('config.yml')
     seed_everything(opt.OPTIM.SEED)
+    if opt.TESTING.SAVE_IMAGES:
+        os.makedirs(opt.TESTING.RESULT_DIR, exist_ok=True)
 
-    accelerator = Accelerator()
+    # the model is not wrapped in DDP, so processes may see a different number of batches
+    # and the last batch is not padded with duplicated samples
+    accelerator = Accelerator(dataloader_config=DataLoaderConfiguration(non_blocking=True, even_batches=False))
     device = accelerator.device
 
     criterion_lpips = LearnedPerceptualImagePatchSimilarity(net_type='alex', normalize=True).to(device)
@@ -35,48 +41,83 @@ def test():
 
     val_dataset = get_data(val_dir, opt.TESTING.INPUT, opt.TESTING.TARGET, 'test', opt.TRAINING.ORI,
                            {'w': opt.TRAINING.PS_W, 'h': opt.TRAINING.PS_H})
-    testloader = DataLoader(dataset=val_dataset, batch_size=1, shuffle=False, num_workers=8, drop_last=False,
-                            pin_memory=True)
+    if opt.TRAINING.ORI:
+        # original-size images cannot be collated into a batch
+        testloader = DataLoader(dataset=val_dataset, batch_size=1, shuffle=False,
+                                num_workers=8, drop_last=False, pin_memory=True, persistent_workers=True,
+                                prefetch_factor=4)
+        testloader = accelerator.prepare(testloader)
+    else:
+        # resized images all have the same shape, decode them once and slice batches from memory
+        testloader = CachedDataLoader(val_dataset, opt.TESTING.EVAL_BATCH, device,
+                                      process_index=accelerator.process_index,
+                                      num_processes=accelerator.num_processes)
 
     # Model & Metrics
     model = Model()
 
     load_checkpoint(model, opt.TESTING.WEIGHT)
+    model = model.to(memory_format=torch.channels_last)
 
-    model, testloader = accelerator.prepare(model, testloader)
+    # inference only, DDP would add collectives to every forward pass
+    model = model.to(device)
+    if opt.MODEL.COMPILE and not opt.TRAINING.ORI:
+        # shapes are only fixed when images are resized
+        model.compile(mode='max-autotune', dynamic=False)
 
     model.eval()
 
-    size = len(testloader)
-    stat_psnr = 0
-    stat_ssim = 0
-    stat_lpips = 0
-    stat_uciqe = 0
-    stat_uiqm = 0
+    # PNG encoding and disk writes run in the background while the GPU keeps going
+    num_writers = os.cpu_count() or 1
+    writer = ThreadPoolExecutor(max_workers=num_writers)
+    saves = deque()
+
+    # running sums stay on the device, synchronised once after the loop
+    stat_psnr = torch.zeros((), device=device)
+    stat_ssim = torch.zeros((), device=device)
+    stat_lpips = torch.zeros((), device=device)
+    stat_uciqe = torch.zeros((), device=device)
+    stat_uiqm = torch.zeros((), device=device)
+    stat_count = torch.zeros((), device=device)
+
+    # no autograd bookkeeping for the model nor the metrics
+    with torch.inference_mode():
+        for _, test_data in enumerate(tqdm(testloader)):
+            # get the inputs; data is a list of [targets, inputs, filename]
+            inp = test_data[0].contiguous(memory_format=torch.channels_last)
+            tar = test_data[1]
 
-    for _, test_data in enumerate(tqdm(testloader)):
-        # get the inputs; data is a list of [targets, inputs, filename]
-        inp = test_data[0].contiguous()
-        tar = test_data[1]
-
-        with torch.no_grad():
             res = model(inp)
 
-        if not os.path.isdir(opt.TESTING.RESULT_DIR):
-            os.makedirs(opt.TESTING.RESULT_DIR)
-        torchvision.utils.save_image(res, os.path.join(opt.TESTING.RESULT_DIR, test_data[2][0]))
+            if opt.TESTING.SAVE_IMAGES:
+                res_cpu = res.detach().cpu()
+                for i in range(res_cpu.size(0)):
+                    saves.append(writer.submit(torchvision.utils.save_image, res_cpu[i],
+                                               os.path.join(opt.TESTING.RESULT_DIR, test_data[2][i])))
+
+                # bound the results held in host memory, and re-raise any write error early
+                while saves and (saves[0].done() or len(saves) > 2 * num_writers):
+                    saves.popleft().result()
+
+            n = res.size(0)
+            stat_psnr += peak_signal_noise_ratio(res, tar, data_range=1, dim=(1, 2, 3), reduction='sum')
+            stat_ssim += structural_similarity_index_measure(res, tar, data_range=1, reduction='sum')
+            stat_lpips += criterion_lpips(res, tar) * n
+            stat_uciqe += batch_uciqe(res) * n
+            stat_uiqm += batch_uiqm(res) * n
+            stat_count += n
+
+    while saves:
+        saves.popleft().result()
+    writer.shutdown(wait=True)
 
-        stat_psnr += peak_signal_noise_ratio(res, tar, data_range=1).item()
-        stat_ssim += structural_similarity_index_measure(res, tar, data_range=1).item()
-        stat_lpips += criterion_lpips(res, tar).item()
-        stat_uciqe += batch_uciqe(res)
-        stat_uiqm += batch_uiqm(res)
+    # each process scored its own part of the test set
+    stats = accelerator.reduce(torch.stack([stat_psnr, stat_ssim, stat_lpips, stat_uciqe, stat_uiqm, stat_count]),
+                               reduction='sum')
+    stat_psnr, stat_ssim, stat_lpips, stat_uciqe, stat_uiqm = (stats[:5] / stats[5]).tolist()
 
-    stat_psnr /= size
-    stat_ssim /= size
-    stat_lpips /= size
-    stat_uciqe /= size
-    stat_uiqm /= size
+    if not accelerator.is_main_process:
+        return
 
     test_info = ("Test Result on {}, check point {}, testing data {}".
                  format(opt.MODEL.SESSION, opt.TESTING.WEIGHT, opt.TESTING.VAL_DIR))
@@ -90,5 +131,4 @@ def test():
 
 
 if __name__ == '__main__':
-    os.makedirs('result', exist_ok=True)
     test()
@@ -2,7 +2,7 @@ import json
 import warnings
 
 import torch.optim as optim
-from accelerate import Accelerator
+from accelerate import Accelerator, DataLoaderConfiguration, DistributedDataParallelKwargs
 from torch import nn
 from torch.utils.data import DataLoader
 
@@ -11,10 +11,11 @@ from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
 from tqdm import tqdm
 
 from config import Config
-from data import get_data
+from data import get_data, get_data_shards
 
-from metrics.uciqe import batch_uciqe
-from metrics.uiqm import batch_uiqm
+from metrics.lpips_cache import TargetCachedLPIPS
+from metrics.uciqe import torch_uciqe
+from metrics.uiqm import torch_uiqm
 
 from torchsampler import ImbalancedDatasetSampler
 
@@ -25,12 +26,23 @@ from utils import *
 warnings.filterwarnings('ignore')
 
 
+def combine_loss(loss_psnr, loss_ssim, loss_lpips):
+    return loss_psnr + 0.3 * loss_ssim + 0.7 * loss_lpips
+
+
 def train():
     # Accelerate
     opt = Config('config.yml')
     seed_everything(opt.OPTIM.SEED)
-
-    accelerator = Accelerator(log_with='wandb') if opt.OPTIM.WANDB else Accelerator()
+    # training crops have a fixed size, let cuDNN pick the fastest kernels
+    torch.backends.cudnn.benchmark = True
+
+    # batches come from pinned memory, so host-to-device copies can be asynchronous
+    accelerator = Accelerator(log_with='wandb' if opt.OPTIM.WANDB else None,
+                              mixed_precision=opt.OPTIM.MIXED_PRECISION,
+                              gradient_accumulation_steps=opt.OPTIM.GRAD_ACCUM_STEPS,
+                              dataloader_config=DataLoaderConfiguration(non_blocking=True),
+                              kwargs_handlers=[DistributedDataParallelKwargs(bucket_cap_mb=opt.OPTIM.BUCKET_CAP_MB)])
     if accelerator.is_local_main_process:
         os.makedirs(opt.TRAINING.SAVE_DIR, exist_ok=True)
     device = accelerator.device
@@ -44,20 +56,31 @@ def train():
     train_dir = opt.TRAINING.TRAIN_DIR
     val_dir = opt.TRAINING.VAL_DIR
 
-    train_dataset = get_data(train_dir, opt.MODEL.INPUT, opt.MODEL.TARGET, 'train', opt.TRAINING.ORI,
-                             {'w': opt.TRAINING.PS_W, 'h': opt.TRAINING.PS_H})
-    trainloader = DataLoader(dataset=train_dataset, batch_size=opt.OPTIM.BATCH_SIZE, shuffle=True, num_workers=16,
-                             drop_last=False, pin_memory=True)
+    if opt.TRAINING.TRAIN_SHARDS:
+        # shards are shuffled by the dataset itself
+        train_dataset = get_data_shards(opt.TRAINING.TRAIN_SHARDS, 'train', opt.TRAINING.ORI,
+                                        {'w': opt.TRAINING.PS_W, 'h': opt.TRAINING.PS_H})
+    else:
+        train_dataset = get_data(train_dir, opt.MODEL.INPUT, opt.MODEL.TARGET, 'train', opt.TRAINING.ORI,
+                                 {'w': opt.TRAINING.PS_W, 'h': opt.TRAINING.PS_H})
+    trainloader = DataLoader(dataset=train_dataset, batch_size=opt.OPTIM.BATCH_SIZE,
+                             shuffle=not opt.TRAINING.TRAIN_SHARDS, num_workers=16,
+                             drop_last=False, pin_memory=True, persistent_workers=True, prefetch_factor=4)
     val_dataset = get_data(val_dir, opt.MODEL.INPUT, opt.MODEL.TARGET, 'test', opt.TRAINING.ORI,
                            {'w': opt.TRAINING.PS_W, 'h': opt.TRAINING.PS_H})
-    testloader = DataLoader(dataset=val_dataset, batch_size=1, shuffle=False, num_workers=8, drop_last=False,
-                            pin_memory=True)
+    # original-size images cannot be collated into a batch
+    eval_batch = 1 if opt.TRAINING.ORI else opt.TESTING.EVAL_BATCH
+    testloader = DataLoader(dataset=val_dataset, batch_size=eval_batch, shuffle=False, num_workers=8,
+                            drop_last=False, pin_memory=True, persistent_workers=True, prefetch_factor=4)
 
     # Model & Loss
-    model = Model()
+    # NHWC lets cuDNN use tensor-core convolution kernels, converted before DDP wraps the model
+    model = Model().to(memory_format=torch.channels_last)
 
     criterion_psnr = torch.nn.SmoothL1Loss()
     criterion_lpips = LearnedPerceptualImagePatchSimilarity(net_type='alex', normalize=True).to(device)
+    # validation targets are deterministic, so their AlexNet features are computed once
+    val_lpips = TargetCachedLPIPS(criterion_lpips)
 
     # Optimizer & Scheduler
     optimizer_b = optim.AdamW(model.parameters(), lr=opt.OPTIM.LR_INITIAL, betas=(0.9, 0.999), eps=1e-8)
@@ -67,67 +90,98 @@ def train():
 
     trainloader, testloader = accelerator.prepare(trainloader, testloader)
     model = accelerator.prepare(model)
+    if opt.MODEL.COMPILE:
+        # compiled in place, so state_dict keys and saved checkpoints are unchanged
+        model.compile(mode='max-autotune', dynamic=False)
+        # one fused kernel instead of a handful of scalar ops
+        loss_fn = torch.compile(combine_loss)
+    else:
+        loss_fn = combine_loss
+    # original-size validation images would trigger a new compile for every shape, so they skip
+    # the compiled __call__ and run the eager forward
+    eval_forward = model.forward if opt.TRAINING.ORI else model
+
     optimizer_b, scheduler_b = accelerator.prepare(optimizer_b, scheduler_b)
 
     best_epoch = 1
     best_psnr = 0
 
-    size = len(testloader)
+    global_step = 0
+    loss_lpips_ema = None
 
     # training
     for epoch in range(start_epoch, opt.OPTIM.NUM_EPOCHS + 1):
         model.train()
 
         for _, data in enumerate(tqdm(trainloader, disable=not accelerator.is_local_main_process)):
-            inp = data[0].contiguous()
-            tar = data[1]
+            inp = data[0].contiguous(memory_format=torch.channels_last)
+            tar = data[1].contiguous(memory_format=torch.channels_last)
+
+            # the optimizer only steps every GRAD_ACCUM_STEPS batches
+            with accelerator.accumulate(model):
+                # forward
+                with accelerator.autocast():
+                    res = model(inp)
+
+                    loss_psnr = criterion_psnr(res, tar)
+
+                # SSIM's E[x^2] - E[x]^2 and AlexNet's convolutions lose too much precision in bf16/fp16
+                with torch.autocast(device_type=device.type, enabled=False):
+                    res = res.float()
+                    tar = tar.float()
 
-            # forward
-            optimizer_b.zero_grad()
-            res = model(inp)
+                    loss_ssim = 1 - structural_similarity_index_measure(res, tar, data_range=1)
+                    if global_step % opt.OPTIM.LPIPS_EVERY == 0:
+                        loss_lpips = criterion_lpips(res, tar)
+                        if loss_lpips_ema is None:
+                            loss_lpips_ema = loss_lpips.detach()
+                        else:
+                            loss_lpips_ema = 0.9 * loss_lpips_ema + 0.1 * loss_lpips.detach()
+                    else:
+                        # the detached running average keeps the loss scale but adds no gradient
+                        loss_lpips = loss_lpips_ema
 
-            loss_psnr = criterion_psnr(res, tar)
-            loss_ssim = 1 - structural_similarity_index_measure(res, tar, data_range=1)
-            loss_lpips = criterion_lpips(res, tar)
+                    train_loss = loss_fn(loss_psnr, loss_ssim, loss_lpips)
 
-            train_loss = loss_psnr + 0.3 * loss_ssim + 0.7 * loss_lpips
+                # backward
+                accelerator.backward(train_loss)
+                optimizer_b.step()
+                optimizer_b.zero_grad(set_to_none=True)
 
-            # backward
-            accelerator.backward(train_loss)
-            optimizer_b.step()
+            global_step += 1
 
         scheduler_b.step()
 
         # testing
         if epoch % opt.TRAINING.VAL_AFTER_EVERY == 0:
             model.eval()
-            psnr = 0
-            ssim = 0
-            lpips = 0
-
-            uciqe = 0
-            uiqm = 0
-
-            for _, data in enumerate(tqdm(testloader, disable=not accelerator.is_local_main_process)):
-                inp = data[0].contiguous()
-                tar = data[1]
-
-                with torch.no_grad():
-                    res = model(inp)
-
-                res, tar = accelerator.gather((res, tar))
-
-                psnr += peak_signal_noise_ratio(res, tar, data_range=1).item()
-                ssim += structural_similarity_index_measure(res, tar, data_range=1).item()
-                lpips += criterion_lpips(res, tar).item()
-                uciqe += batch_uciqe(res)
-                uiqm += batch_uiqm(res)
-
-            psnr /= size
-            ssim /= size
-            lpips /= size
-            uciqe /= size
-            uiqm /= size
+            # running sums of PSNR, SSIM, LPIPS, UCIQE and UIQM stay on the device
+            scores_sum = torch.zeros(5, device=device)
+            count = 0
+
+            # no autograd bookkeeping for the model nor the metrics
+            with torch.inference_mode():
+                for _, data in enumerate(tqdm(testloader, disable=not accelerator.is_local_main_process)):
+                    inp = data[0].contiguous(memory_format=torch.channels_last)
+                    tar = data[1]
+
+                    res = eval_forward(inp)
+
+                    # each process scores its own batch, only the per-image scores are gathered,
+                    # which also drops the samples duplicated to even out the last batch
+                    scores = torch.stack([
+                        peak_signal_noise_ratio(res, tar, data_range=1, dim=(1, 2, 3), reduction='none'),
+                        structural_similarity_index_measure(res, tar, data_range=1, reduction='none'),
+                        val_lpips(res, tar, data[2]),
+                        torch_uciqe(res),
+                        torch_uiqm(res),
+                    ], dim=1)
+                    scores = accelerator.gather_for_metrics(scores)
+
+                    scores_sum += scores.sum(dim=0)
+                    count += scores.size(0)
+
+            psnr, ssim, lpips, uciqe, uiqm = (scores_sum / count).tolist()
 
             if psnr > best_psnr:
                 # save model